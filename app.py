@@ -1,10 +1,34 @@
 import os
+import re
+import sys
 import json
+import gzip
+import zlib
+import bisect
+import struct
+import queue
+import time
 import hashlib
+import tempfile
+import threading
 import uuid
+import asyncio
 import zipfile
-from flask import Flask, render_template_string, request, redirect, url_for, send_from_directory, flash, session, \
-    send_file
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ElementTree
+from contextlib import contextmanager
+import click
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка недоступна
+    fcntl = None
+try:
+    import brotli
+except ImportError:  # без brotli сжимаем только gzip
+    brotli = None
+from flask import Flask, Request, render_template_string, request, redirect, url_for, send_from_directory, flash, session, \
+    send_file, abort
+from markupsafe import escape
 from werkzeug.utils import secure_filename
 
 # === Настройки ===
@@ -13,6 +37,23 @@ ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'ppt', 'pptx', 'txt', 'zip', 'jpg',
 TEACHER_FILE = 'teacher.json'
 PENDING_FILE = 'pending_teachers.json'
 DB_FILE = 'lessons.json'
+CONTENT_INDEX_FILE = 'content_index.json.gz'
+CONTENT_INDEX_MAX_CHARS = 200_000  # сколько символов текста одного файла попадает в индекс
+SNIPPET_RADIUS = 80
+FSCK_STATE_FILE = 'fsck_state.json'
+ORPHAN_GRACE_SECONDS = 60 * 60  # более свежие файлы могут быть незавершёнными загрузками
+EVENTS_LOG = 'events.log'
+ANALYTICS_FILE = 'analytics.json'
+ANALYTICS_LOCK_FILE = 'analytics.lock'  # одна свёртка на все процессы
+EVENTS_LOCK_FILE = 'events.lock'  # запись событий (shared) против ротации журнала (exclusive)
+ANALYTICS_ROLLUP_INTERVAL = 60  # секунд
+ANALYTICS_LOG_ROTATE_BYTES = 10 * 1024 * 1024
+HOURLY_RETENTION_HOURS = 48
+DAILY_RETENTION_DAYS = 90
+EXPORT_FILE = 'library_export.zip'  # кэш архива экспорта, вне папки загрузок
+VIDEO_INDEX_FOLDER = 'video_index'  # индексы ключевых кадров mp4, по файлу на урок
+VIDEO_SEEK_MARKS = 10  # ссылок перехода под видеоплеером
+VIEWABLE_TYPES = ('pdf', 'text', 'image', 'video')
 
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'admin123')
 
@@ -20,8 +61,25 @@ app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'school_library_secret_2024')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50 МБ
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Продакшен-запуск (см. serve()): SERVER = auto | gunicorn | waitress | uvicorn | dev
+SERVER = os.environ.get('SERVER', 'auto')
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 2))  # процессов
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))  # потоков на процесс
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Сжатие ответов
+COMPRESS_MIN_SIZE = 1024  # меньше — выигрыш не окупает заголовки и CPU
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Только текстовые типы: загрузки pdf/zip/docx/pptx/jpg/png/mp4 уже сжаты
+COMPRESS_MIMETYPES = {'text/html', 'text/plain', 'text/css', 'application/javascript', 'application/json',
+                      'application/manifest+json', 'image/svg+xml'}
+STATIC_ASSETS = {'style.css': 'text/css', 'theme.js': 'application/javascript'}
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(VIDEO_INDEX_FOLDER, exist_ok=True)
 
 
 # === Вспомогательные функции ===
@@ -43,6 +101,132 @@ def get_file_type(filename):
         return 'other'
 
 
+# Сигнатуры (magic bytes) допустимых форматов: расширение -> (MIME, возможные префиксы)
+FILE_SIGNATURES = {
+    'pdf': ('application/pdf', (b'%PDF-',)),
+    'doc': ('application/msword', (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',)),
+    'ppt': ('application/vnd.ms-powerpoint', (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',)),
+    'docx': ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', (b'PK\x03\x04',)),
+    'pptx': ('application/vnd.openxmlformats-officedocument.presentationml.presentation', (b'PK\x03\x04',)),
+    'zip': ('application/zip', (b'PK\x03\x04', b'PK\x05\x06')),
+    'jpg': ('image/jpeg', (b'\xff\xd8\xff',)),
+    'jpeg': ('image/jpeg', (b'\xff\xd8\xff',)),
+    'png': ('image/png', (b'\x89PNG\r\n\x1a\n',)),
+    'mp4': ('video/mp4', ()),
+    'txt': ('text/plain', ()),
+}
+
+
+def signature_matches(ext, head):
+    if ext == 'mp4':
+        return head[4:8] == b'ftyp'
+    if ext == 'txt':
+        return b'\x00' not in head
+    return any(head.startswith(sig) for sig in FILE_SIGNATURES[ext][1])
+
+
+class UploadRejected(Exception):
+    pass
+
+
+# Файл из формы загрузки пишется прямо во временный файл в папке загрузок, пока
+# разбирается multipart-тело: сигнатура проверяется по первому блоку (при несовпадении
+# разбор прерывается), размер и SHA-256 считаются по ходу записи. Не сохранённый
+# через commit() временный файл удаляется при закрытии (в конце запроса).
+# Ограничение размера обеспечивает MAX_CONTENT_LENGTH ещё до разбора запроса.
+class UploadSink:
+    def __init__(self, ext):
+        self.ext = ext
+        self.path = tmp_path_for(os.path.join(UPLOAD_FOLDER, f"upload_{uuid.uuid4().hex}"))
+        self.file = open(self.path, 'w+b')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.committed = False
+
+    def write(self, data):
+        if self.head is None:
+            self._write(data)
+        else:
+            self.head += data
+            if len(self.head) >= UPLOAD_CHUNK_SIZE:
+                self._check_head()
+        return len(data)
+
+    def _write(self, data):
+        self.size += len(data)
+        self.digest.update(data)
+        self.file.write(data)
+
+    def _check_head(self):
+        head, self.head = self.head, None
+        if not head:
+            error = "Файл пустой."
+        elif not signature_matches(self.ext, head):
+            error = "Содержимое файла не соответствует расширению."
+        else:
+            self._write(head)
+            return
+        self.close()
+        raise UploadRejected(error)
+
+    def seek(self, offset, whence=0):
+        # MultiPartParser вызывает seek(0), когда часть с файлом прочитана целиком
+        if self.head is not None:
+            self._check_head()
+        return self.file.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def commit(self, filepath):
+        self.file.close()
+        os.replace(self.path, filepath)
+        self.committed = True
+        return {
+            "mime": FILE_SIGNATURES[self.ext][0],
+            "size": self.size,
+            "sha256": self.digest.hexdigest(),
+            "file_type": get_file_type(filepath),
+        }
+
+    def close(self):
+        self.file.close()
+        if not self.committed:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != 'teacher_upload' or not filename:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if not allowed_file(filename):
+            raise UploadRejected("Недопустимый формат файла.")
+        return UploadSink(filename.rsplit('.', 1)[1].lower())
+
+
+app.request_class = UploadRequest
+
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    flash(f"❌ {e}", "error")
+    return redirect(url_for('teacher_upload'))
+
+
+def lesson_file_type(lesson):
+    # Старые записи без метаданных — по расширению
+    return lesson.get('file_type') or get_file_type(lesson['filename'])
+
+
+def tmp_path_for(path):
+    # Уникальное имя на процесс и поток: несколько воркеров могут писать один файл одновременно
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
@@ -90,9 +274,900 @@ def load_lessons():
         return []
 
 
+_lessons_by_filename = (None, {})  # (stat-ключ lessons.json, filename -> урок)
+
+
+def lesson_by_filename(filename):
+    # Каталог перечитывается, только если lessons.json изменился: на запрос остаётся один stat
+    global _lessons_by_filename
+    try:
+        stat = os.stat(DB_FILE)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+    cached_key, lessons = _lessons_by_filename
+    if key != cached_key:
+        lessons = {lesson['filename']: lesson for lesson in load_lessons()}
+        _lessons_by_filename = (key, lessons)
+    return lessons.get(filename)
+
+
 def save_lessons(lessons):
-    with open(DB_FILE, 'w', encoding='utf-8') as f:
+    # Через временный файл: параллельный читатель не должен увидеть наполовину записанный каталог
+    tmp_path = tmp_path_for(DB_FILE)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(lessons, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, DB_FILE)
+
+
+# === Извлечение текста из документов ===
+INDEXABLE_EXTENSIONS = {'txt', 'docx', 'pptx', 'pdf'}
+MAX_EXTRACT_BYTES = 50 * 1024 * 1024  # защита от zip- и deflate-бомб
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+DRAWING_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+
+_PDF_STREAM_RE = re.compile(rb'stream\r?\n(.*?)\r?\nendstream', re.S)
+_PDF_TOKEN_RE = re.compile(
+    rb'\((?:\\.|[^\\()]|\((?:\\.|[^\\()])*\))*\)'  # строка (…), допускается одна вложенность скобок
+    rb'|<[0-9A-Fa-f\s]*>'                           # hex-строка
+    rb'|%[^\r\n]*'                                  # комментарий
+    rb'|[A-Za-z\'"*]+',                             # оператор
+    re.S)
+_PDF_ESCAPE_RE = re.compile(rb'\\([0-7]{1,3}|\r\n|.)', re.S)
+_PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+_PDF_SHOW_OPS = {b'Tj', b'TJ', b"'", b'"'}
+_PDF_BREAK_OPS = {b'Td', b'TD', b'T*', b'ET', b"'", b'"'}
+
+
+def _decode_text_bytes(data):
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # Обрезанный на границе многобайтового символа хвост — не повод менять кодировку
+        if e.start >= len(data) - 3:
+            return data[:e.start].decode('utf-8', errors='replace')
+    return data.decode('cp1251', errors='replace')
+
+
+def extract_txt(path):
+    with open(path, 'rb') as f:
+        return _decode_text_bytes(f.read(CONTENT_INDEX_MAX_CHARS * 4))
+
+
+def _read_zip_member(zf, name):
+    info = zf.getinfo(name)
+    if info.file_size > MAX_EXTRACT_BYTES:
+        raise ValueError(f"слишком большой элемент архива: {name}")
+    return zf.open(info)
+
+
+def _ooxml_paragraphs(stream, text_tag, paragraph_tag):
+    parts = []
+    for event, elem in ElementTree.iterparse(stream, events=('end',)):
+        if elem.tag == text_tag and elem.text:
+            parts.append(elem.text)
+        elif elem.tag == paragraph_tag:
+            parts.append('\n')
+            elem.clear()
+        elif elem.tag == WORD_NS + 'tab':
+            parts.append(' ')
+    return ''.join(parts)
+
+
+def extract_docx(path):
+    with zipfile.ZipFile(path) as zf:
+        with _read_zip_member(zf, 'word/document.xml') as stream:
+            return _ooxml_paragraphs(stream, WORD_NS + 't', WORD_NS + 'p')
+
+
+def extract_pptx(path):
+    slide_re = re.compile(r'ppt/slides/slide(\d+)\.xml$')
+    with zipfile.ZipFile(path) as zf:
+        slides = sorted((int(m.group(1)), name) for name in zf.namelist() for m in [slide_re.match(name)] if m)
+        texts = []
+        for _, name in slides:
+            with _read_zip_member(zf, name) as stream:
+                texts.append(_ooxml_paragraphs(stream, DRAWING_NS + 't', DRAWING_NS + 'p'))
+        return '\n'.join(texts)
+
+
+def _pdf_unescape(raw):
+    def repl(m):
+        seq = m.group(1)
+        if seq[:1].isdigit():
+            return bytes([int(seq, 8) & 0xFF])
+        if seq in (b'\n', b'\r', b'\r\n'):
+            return b''
+        return _PDF_ESCAPES.get(seq, seq)
+
+    data = _PDF_ESCAPE_RE.sub(repl, raw)
+    if data.startswith(b'\xfe\xff'):
+        return data[2:].decode('utf-16-be', errors='replace')
+    return data.decode('latin-1')
+
+
+def _pdf_content_text(content):
+    parts = []
+    pending = []
+    for m in _PDF_TOKEN_RE.finditer(content):
+        token = m.group(0)
+        if token[:1] == b'(':
+            pending.append(_pdf_unescape(token[1:-1]))
+            continue
+        if token[:1] in (b'<', b'%'):
+            continue
+        if token in _PDF_SHOW_OPS:
+            parts.append(''.join(pending))
+        if token in _PDF_BREAK_OPS:
+            parts.append(' ')
+        pending = []
+    return ''.join(parts)
+
+
+def extract_pdf(path):
+    # Только то, что умеет стандартная библиотека: несжатые и FlateDecode-потоки,
+    # строки в операторах Tj/TJ. Шрифты с CID-кодировкой без ToUnicode не распознаются.
+    with open(path, 'rb') as f:
+        data = f.read(MAX_EXTRACT_BYTES)
+    texts = []
+    for m in _PDF_STREAM_RE.finditer(data):
+        raw = m.group(1)
+        try:
+            content = zlib.decompressobj().decompress(raw, MAX_EXTRACT_BYTES)
+        except zlib.error:
+            content = raw
+        if b'BT' not in content:
+            continue
+        text = _pdf_content_text(content)
+        if text.strip():
+            texts.append(text)
+    return '\n'.join(texts)
+
+
+TEXT_EXTRACTORS = {
+    'txt': extract_txt,
+    'docx': extract_docx,
+    'pptx': extract_pptx,
+    'pdf': extract_pdf,
+}
+
+
+def extract_text(path):
+    ext = path.rsplit('.', 1)[-1].lower()
+    extractor = TEXT_EXTRACTORS.get(ext)
+    if extractor is None:
+        return ''
+    return ' '.join(extractor(path).split())[:CONTENT_INDEX_MAX_CHARS]
+
+
+# === Индекс содержимого файлов ===
+# Индексом владеет фоновый поток: он извлекает текст после загрузки, удаляет записи,
+# сохраняет content_index.json.gz и подхватывает изменения других процессов.
+# Запросы читают только готовый снимок {"texts", "postings", "tokens"} без блокировок:
+# postings — слово -> [(файл, смещение первого вхождения)], tokens — отсортированный
+# словарь для поиска по префиксу; сниппет вырезается из текста по смещению.
+TOKEN_RE = re.compile(r'\w+')
+CONTENT_INDEX_RELOAD_INTERVAL = 30  # секунд простоя между проверками чужих изменений
+
+_content_index = {"texts": {}, "postings": {}, "tokens": []}
+_extract_queue = queue.Queue()
+_extract_pending = set()
+_extract_pending_lock = threading.Lock()
+
+# Состояние потока-индексатора (другие потоки его не трогают)
+_indexed_texts = {}  # filename -> нормализованный текст
+_indexed_terms = {}  # filename -> {слово: смещение}
+_index_dirty = {}  # filename -> текст или None (удаление), ещё не записанные на диск
+_index_mtime = None
+
+
+def _document_terms(text):
+    terms = {}
+    for m in TOKEN_RE.finditer(text):
+        terms.setdefault(m.group().lower(), m.start())
+    return terms
+
+
+def _apply_indexed_text(filename, text):
+    if text is None:
+        _indexed_texts.pop(filename, None)
+        _indexed_terms.pop(filename, None)
+    else:
+        _indexed_texts[filename] = text
+        _indexed_terms[filename] = _document_terms(text)
+
+
+def _publish_content_index():
+    global _content_index
+    postings = {}
+    for filename, terms in _indexed_terms.items():
+        for token, offset in terms.items():
+            postings.setdefault(token, []).append((filename, offset))
+    _content_index = {"texts": dict(_indexed_texts), "postings": postings, "tokens": sorted(postings)}
+
+
+def _reload_content_index():
+    # True, если файл на диске изменился (например, его записал другой процесс)
+    global _index_mtime
+    try:
+        mtime = os.path.getmtime(CONTENT_INDEX_FILE)
+    except OSError:
+        return False
+    if mtime == _index_mtime:
+        return False
+    try:
+        with gzip.open(CONTENT_INDEX_FILE, 'rt', encoding='utf-8') as f:
+            stored = json.load(f)
+    except (OSError, EOFError, json.JSONDecodeError) as e:
+        app.logger.error(f"Ошибка чтения индекса содержимого: {e}")
+        return False
+    _indexed_texts.clear()
+    _indexed_texts.update(stored['texts'])
+    _indexed_terms.clear()
+    _indexed_terms.update(stored['terms'])
+    for filename, text in _index_dirty.items():
+        _apply_indexed_text(filename, text)
+    _index_mtime = mtime
+    return True
+
+
+def _write_content_index():
+    global _index_mtime
+    # Другой процесс мог обновить индекс — подтягиваем его записи перед сохранением
+    _reload_content_index()
+    tmp_path = tmp_path_for(CONTENT_INDEX_FILE)
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        json.dump({"texts": _indexed_texts, "terms": _indexed_terms}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, CONTENT_INDEX_FILE)
+    _index_mtime = os.path.getmtime(CONTENT_INDEX_FILE)
+    _index_dirty.clear()
+
+
+def _extraction_loop():
+    _reload_content_index()
+    _publish_content_index()
+    for lesson in load_lessons():
+        if lesson['filename'] not in _indexed_texts:
+            enqueue_extraction(lesson['filename'])
+
+    while True:
+        try:
+            action, filename = _extract_queue.get(timeout=CONTENT_INDEX_RELOAD_INTERVAL)
+        except queue.Empty:
+            if _reload_content_index():
+                _publish_content_index()
+            continue
+
+        if action == 'extract':
+            try:
+                text = extract_text(os.path.join(UPLOAD_FOLDER, filename))
+            except Exception as e:
+                app.logger.warning(f"Не удалось извлечь текст из {filename}: {e}")
+                text = ''
+            with _extract_pending_lock:
+                _extract_pending.discard(filename)
+        else:
+            text = None
+        _apply_indexed_text(filename, text)
+        _index_dirty[filename] = text
+
+        if _extract_queue.empty():
+            try:
+                _write_content_index()
+            except Exception as e:
+                app.logger.error(f"Ошибка сохранения индекса содержимого: {e}")
+            _publish_content_index()
+
+
+def enqueue_extraction(filename):
+    if filename.rsplit('.', 1)[-1].lower() not in INDEXABLE_EXTENSIONS:
+        return
+    with _extract_pending_lock:
+        if filename in _extract_pending:
+            return
+        _extract_pending.add(filename)
+    _extract_queue.put(('extract', filename))
+
+
+def remove_from_content_index(filename):
+    _extract_queue.put(('remove', filename))
+
+
+def search_content(query):
+    # Все слова запроса должны встретиться в документе (как префиксы слов);
+    # сниппет строится вокруг первого вхождения первого слова
+    index = _content_index
+    words = [word.lower() for word in TOKEN_RE.findall(query)]
+    if not words:
+        return {}
+    matches = None
+    for word in words:
+        found = {}
+        position = bisect.bisect_left(index['tokens'], word)
+        while position < len(index['tokens']) and index['tokens'][position].startswith(word):
+            for filename, offset in index['postings'][index['tokens'][position]]:
+                if matches is None or filename in matches:
+                    found[filename] = min(offset, found.get(filename, offset))
+            position += 1
+        matches = found if matches is None else {name: matches[name] for name in found}
+        if not matches:
+            return {}
+    return {filename: content_snippet(index['texts'][filename], offset, len(words[0]))
+            for filename, offset in matches.items()}
+
+
+def content_snippet(text, offset, length):
+    start = max(0, offset - SNIPPET_RADIUS)
+    end = min(len(text), offset + length + SNIPPET_RADIUS)
+    return ('…' if start > 0 else '') + text[start:end] + ('…' if end < len(text) else '')
+
+
+threading.Thread(target=_extraction_loop, name='text-extractor', daemon=True).start()
+
+
+# === Проверка согласованности папки загрузок ===
+# Один проход os.scandir по дереву загрузок сверяется с lessons.json.
+# SHA-256 пересчитывается только для файлов, у которых с прошлой проверки
+# изменились размер или mtime (кэш в fsck_state.json).
+def _load_fsck_state():
+    try:
+        with open(FSCK_STATE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _save_fsck_state(state):
+    tmp_path = tmp_path_for(FSCK_STATE_FILE)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, FSCK_STATE_FILE)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_uploads():
+    catalog = {lesson['filename']: lesson for lesson in load_lessons()}
+    previous = _load_fsck_state()
+    now = time.time()
+
+    found = {}
+    orphans = []
+    pending_dirs = ['']
+    while pending_dirs:
+        rel_dir = pending_dirs.pop()
+        with os.scandir(os.path.join(UPLOAD_FOLDER, rel_dir)) as entries:
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(rel_path)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                if rel_dir or entry.name not in catalog:
+                    orphans.append({"path": os.path.join(UPLOAD_FOLDER, rel_path), "size": stat.st_size,
+                                    "age": now - stat.st_mtime})
+                else:
+                    found[entry.name] = stat
+
+    # Индексы ключевых кадров удалённых видео и недописанные временные файлы индексов
+    indexed = {os.path.basename(video_index_path(filename)) for filename in catalog}
+    with os.scandir(VIDEO_INDEX_FOLDER) as entries:
+        for entry in entries:
+            if entry.name not in indexed:
+                stat = entry.stat(follow_symlinks=False)
+                orphans.append({"path": entry.path, "size": stat.st_size, "age": now - stat.st_mtime})
+
+    state = {}
+    missing = []
+    damaged = []
+    for filename, lesson in catalog.items():
+        stat = found.get(filename)
+        if stat is None:
+            missing.append(lesson)
+            continue
+        key = [stat.st_size, stat.st_mtime_ns]
+        cached = previous.get(filename)
+        if cached and cached[:2] == key:
+            sha256 = cached[2]
+        elif 'sha256' in lesson:
+            sha256 = file_sha256(os.path.join(UPLOAD_FOLDER, filename))
+        else:
+            sha256 = None
+        state[filename] = key + [sha256]
+        if lesson.get('size', stat.st_size) != stat.st_size or lesson.get('sha256', sha256) != sha256:
+            damaged.append(lesson)
+
+    _save_fsck_state(state)
+    return {"checked": len(found), "orphans": orphans, "missing": missing, "damaged": damaged}
+
+
+def reclaim_orphans(report):
+    removed = 0
+    freed = 0
+    emptied_dirs = set()
+    for orphan in report['orphans']:
+        if orphan['age'] < ORPHAN_GRACE_SECONDS:
+            continue
+        try:
+            os.remove(orphan['path'])
+        except OSError as e:
+            app.logger.error(f"Не удалось удалить {orphan['path']}: {e}")
+            continue
+        removed += 1
+        freed += orphan['size']
+        folder = os.path.dirname(orphan['path'])
+        while folder not in ('', UPLOAD_FOLDER, VIDEO_INDEX_FOLDER):
+            emptied_dirs.add(folder)
+            folder = os.path.dirname(folder)
+    # Опустевшие подпапки тоже убираем, начиная с самых глубоких
+    for folder in sorted(emptied_dirs, key=len, reverse=True):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass
+    return removed, freed
+
+
+def format_size(size):
+    for unit in ('Б', 'КБ', 'МБ'):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+# === Аналитика скачиваний и просмотров ===
+# События дописываются в events.log, фоновый поток раз в ANALYTICS_ROLLUP_INTERVAL
+# сворачивает новые строки в почасовые и посуточные счётчики analytics.json.
+# Админка читает только готовые счётчики.
+EVENT_KINDS = ('download', 'view')
+
+_events_lock = threading.Lock()
+_rollup_lock = threading.Lock()
+_rollup_worker = None
+
+
+def _hour_key(timestamp):
+    return time.strftime('%Y-%m-%d %H', time.localtime(timestamp))
+
+
+def _day_key(timestamp):
+    return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+
+def load_analytics():
+    try:
+        with open(ANALYTICS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"offset": 0, "totals": {}, "hourly": {}, "daily": {}, "lessons": {}}
+
+
+@contextmanager
+def _file_lock(path, exclusive=False):
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+@contextmanager
+def _rollup_locked():
+    # Свёртка не трогает _events_lock: запись событий во время неё не ждёт
+    with _rollup_lock, _file_lock(ANALYTICS_LOCK_FILE, exclusive=True):
+        yield
+
+
+def _read_events(path, offset):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read()
+    except FileNotFoundError:
+        return b''
+
+
+def _save_analytics(aggregates):
+    tmp_path = tmp_path_for(ANALYTICS_FILE)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(aggregates, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, ANALYTICS_FILE)
+
+
+def _bump(buckets, key, kind):
+    counts = buckets.setdefault(key, {})
+    counts[kind] = counts.get(kind, 0) + 1
+
+
+def _prune_buckets(buckets, oldest_key):
+    for key in [key for key in buckets if key < oldest_key]:
+        del buckets[key]
+
+
+def rollup_events():
+    with _rollup_locked():
+        aggregates = load_analytics()
+        data = _read_events(EVENTS_LOG, aggregates['offset'])
+        # Последняя строка может быть дописана не до конца — оставляем её на следующий раз
+        data = data[:data.rfind(b'\n') + 1]
+        offset = aggregates['offset'] + len(data)
+
+        # Большой журнал сначала переименовываем, потом дочитываем: пока держим exclusive-блокировку,
+        # никто не пишет, а после неё новые строки идут уже в свежий events.log
+        if offset >= ANALYTICS_LOG_ROTATE_BYTES:
+            with _events_lock, _file_lock(EVENTS_LOCK_FILE, exclusive=True):
+                os.replace(EVENTS_LOG, EVENTS_LOG + '.1')
+            data += _read_events(EVENTS_LOG + '.1', offset)
+            offset = 0
+
+        for line in data.splitlines():
+            try:
+                event = json.loads(line)
+                timestamp, kind, filename = event['t'], event['e'], event['f']
+            except (ValueError, KeyError):
+                continue
+            hour, day = _hour_key(timestamp), _day_key(timestamp)
+            lesson_stats = aggregates['lessons'].setdefault(filename, {"totals": {}, "hourly": {}, "daily": {}})
+            for stats in (aggregates, lesson_stats):
+                stats['totals'][kind] = stats['totals'].get(kind, 0) + 1
+                _bump(stats['hourly'], hour, kind)
+                _bump(stats['daily'], day, kind)
+        aggregates['offset'] = offset
+
+        now = time.time()
+        oldest_hour = _hour_key(now - HOURLY_RETENTION_HOURS * 3600)
+        oldest_day = _day_key(now - DAILY_RETENTION_DAYS * 86400)
+        for stats in [aggregates, *aggregates['lessons'].values()]:
+            _prune_buckets(stats['hourly'], oldest_hour)
+            _prune_buckets(stats['daily'], oldest_day)
+        _save_analytics(aggregates)
+
+
+def _rollup_loop():
+    # Первая свёртка сразу: события, записанные до перезапуска, не ждут полного интервала
+    while True:
+        try:
+            rollup_events()
+        except Exception as e:
+            app.logger.error(f"Ошибка свёртки аналитики: {e}")
+        time.sleep(ANALYTICS_ROLLUP_INTERVAL)
+
+
+def _start_rollup_worker():
+    global _rollup_worker
+    with _rollup_locked():
+        if _rollup_worker is not None:
+            return
+        if not os.path.exists(ANALYTICS_FILE):
+            # Первый запуск: переносим счётчики скачиваний, накопленные в каталоге до появления журнала
+            aggregates = load_analytics()
+            for lesson in load_lessons():
+                downloads = lesson.get('downloads', 0)
+                aggregates['totals']['download'] = aggregates['totals'].get('download', 0) + downloads
+                lesson_stats = {"totals": {"download": downloads}, "hourly": {}, "daily": {}}
+                aggregates['lessons'][lesson['filename']] = lesson_stats
+            _save_analytics(aggregates)
+        _rollup_worker = threading.Thread(target=_rollup_loop, name='analytics-rollup', daemon=True)
+        _rollup_worker.start()
+
+
+def record_event(kind, filename):
+    line = json.dumps({"t": int(time.time()), "e": kind, "f": filename}, ensure_ascii=False) + '\n'
+    with _events_lock, _file_lock(EVENTS_LOCK_FILE):
+        with open(EVENTS_LOG, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+_download_counts = (None, {})  # (stat-ключ analytics.json, filename -> скачиваний)
+
+
+def download_counts():
+    # Для главной: analytics.json перечитывается, только если его обновила свёртка
+    global _download_counts
+    try:
+        stat = os.stat(ANALYTICS_FILE)
+        key = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        key = None
+    cached_key, counts = _download_counts
+    if key != cached_key:
+        counts = {filename: stats['totals'].get('download', 0)
+                  for filename, stats in load_analytics()['lessons'].items()}
+        _download_counts = (key, counts)
+    return counts
+
+
+def top_lessons(aggregates, kind, days=7, limit=10):
+    oldest_day = _day_key(time.time() - (days - 1) * 86400)
+    scores = []
+    for filename, stats in aggregates['lessons'].items():
+        count = sum(counts.get(kind, 0) for day, counts in stats['daily'].items() if day >= oldest_day)
+        if count:
+            scores.append((count, filename))
+    scores.sort(reverse=True)
+    return scores[:limit]
+
+
+def daily_trend(aggregates, days=14):
+    now = time.time()
+    keys = [_day_key(now - offset * 86400) for offset in range(days - 1, -1, -1)]
+    return [(key, aggregates['daily'].get(key, {})) for key in keys]
+
+
+def hourly_trend(aggregates, hours=24):
+    now = time.time()
+    keys = [_hour_key(now - offset * 3600) for offset in range(hours - 1, -1, -1)]
+    return [(key, aggregates['hourly'].get(key, {})) for key in keys]
+
+
+_start_rollup_worker()
+
+
+# === MP4: перенос moov в начало и индекс ключевых кадров ===
+# Разбирается один раз при загрузке. Если moov лежит после mdat, файл переписывается
+# с moov в начале (смещения чанков в stco/co64 сдвигаются), чтобы браузер начал
+# воспроизведение после небольшого range-запроса. Таблица «время -> смещение»
+# ключевых кадров сохраняется в VIDEO_INDEX_FOLDER, сводка — в записи урока.
+MP4_CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'dinf'}
+MAX_MOOV_SIZE = 16 * 1024 * 1024
+
+
+def _iter_boxes(data, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise ValueError(f"повреждённый бокс {box_type!r}")
+        yield box_type, pos + header_size, pos + size
+        pos += size
+
+
+def _walk_boxes(data, start, end):
+    for box_type, body_start, body_end in _iter_boxes(data, start, end):
+        yield box_type, body_start, body_end
+        if box_type in MP4_CONTAINER_BOXES:
+            yield from _walk_boxes(data, body_start, body_end)
+
+
+def _find_box(data, path, start, end):
+    for box_type, body_start, body_end in _iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return body_start, body_end
+            found = _find_box(data, path[1:], body_start, body_end)
+            if found:
+                return found
+    return None
+
+
+def _table(data, box, fmt, fields=1):
+    # Таблица полного бокса: version/flags, число записей, записи
+    start, end = box
+    count = struct.unpack_from('>I', data, start + 4)[0]
+    item_size = struct.calcsize('>' + fmt) * fields
+    if start + 8 + count * item_size > end:
+        raise ValueError("таблица выходит за границы бокса")
+    values = struct.unpack_from(f'>{count * fields}{fmt}', data, start + 8)
+    if fields == 1:
+        return values
+    return [values[i:i + fields] for i in range(0, len(values), fields)]
+
+
+def _mp4_top_level_boxes(f):
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    boxes = []
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size or pos + size > file_size:
+            raise ValueError(f"повреждённый бокс {box_type!r}")
+        boxes.append((box_type, pos, size))
+        pos += size
+    return boxes
+
+
+def _shift_chunk_offsets(moov, shift, first, last):
+    # Сдвигаются только данные между первым mdat и старым местом moov;
+    # то, что лежало после moov, после переноса остаётся на своих смещениях
+    def shifted(offsets):
+        return [offset + shift if first <= offset < last else offset for offset in offsets]
+
+    for box_type, start, end in _walk_boxes(moov, 0, len(moov)):
+        if box_type == b'stco':
+            offsets = shifted(_table(moov, (start, end), 'I'))
+            if offsets and max(offsets) > 0xFFFFFFFF:
+                raise ValueError("смещения не помещаются в stco")
+            struct.pack_into(f'>{len(offsets)}I', moov, start + 8, *offsets)
+        elif box_type == b'co64':
+            offsets = shifted(_table(moov, (start, end), 'Q'))
+            struct.pack_into(f'>{len(offsets)}Q', moov, start + 8, *offsets)
+
+
+def _move_moov_to_front(path, boxes, moov_box, first_mdat):
+    # moov встаёт прямо перед первым mdat; смещения в moov_box должны быть уже сдвинуты
+    tmp_path = tmp_path_for(path)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            for box_type, offset, box_size in boxes:
+                if box_type == b'moov':
+                    continue
+                if offset == first_mdat:
+                    dst.write(moov_box)
+                    digest.update(moov_box)
+                    size += len(moov_box)
+                src.seek(offset)
+                remaining = box_size
+                while remaining > 0:
+                    chunk = src.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise ValueError("файл обрезан")
+                    dst.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                    remaining -= len(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {"size": size, "sha256": digest.hexdigest()}
+
+
+def _keyframe_index(moov):
+    header_size = 16 if struct.unpack_from('>I', moov)[0] == 1 else 8
+    for box_type, trak_start, trak_end in _iter_boxes(moov, header_size, len(moov)):
+        if box_type != b'trak':
+            continue
+        hdlr = _find_box(moov, [b'mdia', b'hdlr'], trak_start, trak_end)
+        if hdlr and moov[hdlr[0] + 8:hdlr[0] + 12] == b'vide':
+            break
+    else:
+        raise ValueError("нет видеодорожки")
+
+    mdhd_start, _ = _find_box(moov, [b'mdia', b'mdhd'], trak_start, trak_end)
+    if moov[mdhd_start] == 1:
+        timescale, duration = struct.unpack_from('>IQ', moov, mdhd_start + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', moov, mdhd_start + 12)
+
+    tkhd_start, _ = _find_box(moov, [b'tkhd'], trak_start, trak_end)
+    width, height = struct.unpack_from('>II', moov, tkhd_start + (88 if moov[tkhd_start] == 1 else 76))
+
+    stbl = _find_box(moov, [b'mdia', b'minf', b'stbl'], trak_start, trak_end)
+
+    def stbl_box(name):
+        return _find_box(moov, [name], *stbl)
+
+    stsz = stbl_box(b'stsz')
+    sample_size, sample_count = struct.unpack_from('>II', moov, stsz[0] + 4)
+    if sample_size:
+        sizes = [sample_size] * sample_count
+    else:
+        sizes = struct.unpack_from(f'>{sample_count}I', moov, stsz[0] + 12)
+    chunk_offsets = _table(moov, stbl_box(b'stco'), 'I') if stbl_box(b'stco') else _table(moov, stbl_box(b'co64'), 'Q')
+    sample_to_chunk = _table(moov, stbl_box(b'stsc'), 'I', 3)
+
+    offsets = []
+    for i, (first_chunk, per_chunk, _) in enumerate(sample_to_chunk):
+        last_chunk = sample_to_chunk[i + 1][0] - 1 if i + 1 < len(sample_to_chunk) else len(chunk_offsets)
+        for chunk_offset in chunk_offsets[first_chunk - 1:last_chunk]:
+            for _ in range(per_chunk):
+                if len(offsets) == sample_count:
+                    break
+                offsets.append(chunk_offset)
+                chunk_offset += sizes[len(offsets) - 1]
+
+    times = []
+    elapsed = 0
+    for count, delta in _table(moov, stbl_box(b'stts'), 'I', 2):
+        for _ in range(count):
+            times.append(elapsed)
+            elapsed += delta
+
+    stss = stbl_box(b'stss')
+    if stss:
+        sync_samples = [number - 1 for number in _table(moov, stss, 'I')]
+    else:
+        # Все кадры ключевые — достаточно одной точки в секунду
+        sync_samples = [n for n in range(len(times)) if n == 0 or times[n] // timescale != times[n - 1] // timescale]
+    keyframes = [[round(times[n] / timescale, 3), offsets[n]]
+                 for n in sync_samples if n < len(times) and n < len(offsets)]
+
+    return {
+        "duration": round(duration / timescale, 3) if timescale else 0,
+        "width": width >> 16,
+        "height": height >> 16,
+        "keyframes": keyframes,
+    }
+
+
+def video_index_path(filename):
+    return os.path.join(VIDEO_INDEX_FOLDER, filename + '.json')
+
+
+def prepare_mp4(path, filename):
+    with open(path, 'rb') as f:
+        boxes = _mp4_top_level_boxes(f)
+        moov = next(((offset, size) for box_type, offset, size in boxes if box_type == b'moov'), None)
+        if moov is None:
+            raise ValueError("в файле нет moov")
+        if moov[1] > MAX_MOOV_SIZE:
+            raise ValueError("moov слишком большой")
+        f.seek(moov[0])
+        moov_box = bytearray(f.read(moov[1]))
+
+    updates = {}
+    moov_offset = moov[0]
+    mdat_offset = min((offset for box_type, offset, size in boxes if box_type == b'mdat'), default=None)
+    move_moov = mdat_offset is not None and moov_offset > mdat_offset
+    if move_moov:
+        _shift_chunk_offsets(moov_box, len(moov_box), mdat_offset, moov_offset)
+        moov_offset = mdat_offset
+
+    # Индекс строится до перезаписи файла: если видео не разбирается, файл остаётся как загружен
+    index = _keyframe_index(moov_box)
+    index['moov_end'] = moov_offset + len(moov_box)
+    if move_moov:
+        updates = _move_moov_to_front(path, boxes, moov_box, mdat_offset)
+    tmp_path = tmp_path_for(video_index_path(filename))
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_path, video_index_path(filename))
+
+    updates['video'] = {
+        "duration": index['duration'],
+        "width": index['width'],
+        "height": index['height'],
+        "keyframes": len(index['keyframes']),
+        "moov_end": index['moov_end'],
+    }
+    return updates
+
+
+def keyframe_times(filename):
+    try:
+        with open(video_index_path(filename), 'r', encoding='utf-8') as f:
+            keyframes = json.load(f)['keyframes']
+    except (OSError, ValueError, KeyError):
+        return []
+    return [time_ for time_, _ in keyframes]
+
+
+def keyframe_before(times, seconds):
+    if not times:
+        return seconds
+    position = bisect.bisect_right(times, seconds) - 1
+    return times[position] if position >= 0 else 0
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
 
 
 # === Декораторы ===
@@ -146,141 +1221,7 @@ BASE_TEMPLATE = '''
     <title>{{ page_title }}</title>
     <link rel="manifest" href="/manifest.json">
     <meta name="theme-color" content="#4285f4">
-    <style>
-        :root {
-            --bg: #ffffff;
-            --card-bg: #ffffff;
-            --text: #202124;
-            --text-light: #5f6368;
-            --border: #dadce0;
-            --primary: #4285f4;
-            --primary-dark: #3367d6;
-            --success: #34a853;
-            --error: #ea4335;
-        }
-        [data-theme="dark"] {
-            --bg: #121212;
-            --card-bg: #1e1e1e;
-            --text: #e8eaed;
-            --text-light: #9aa0a6;
-            --border: #3c4043;
-            --primary: #8ab4f8;
-            --primary-dark: #7f9ed6;
-            --success: #81c995;
-            --error: #f28b82;
-        }
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        body {
-            background-color: var(--bg);
-            color: var(--text);
-            font-family: 'Roboto', Arial, sans-serif;
-            line-height: 1.6;
-            padding-bottom: 40px;
-            transition: background-color 0.3s, color 0.3s;
-        }
-        .container {
-            max-width: 900px;
-            margin: 0 auto;
-            padding: 0 20px;
-        }
-        header {
-            background: var(--primary);
-            color: white;
-            padding: 24px 0;
-            text-align: center;
-            box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-        }
-        header h1 {
-            font-weight: 500;
-            font-size: 28px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            gap: 12px;
-        }
-        .logo {
-            font-size: 28px;
-        }
-        .content {
-            margin-top: 30px;
-        }
-        .card {
-            background: var(--card-bg);
-            border: 1px solid var(--border);
-            border-radius: 12px;
-            padding: 24px;
-            margin-bottom: 24px;
-            transition: transform 0.2s, box-shadow 0.2s;
-        }
-        .btn {
-            display: inline-block;
-            background: var(--primary);
-            color: white;
-            text-decoration: none;
-            padding: 10px 20px;
-            border-radius: 6px;
-            font-weight: 500;
-            transition: background 0.2s;
-            border: none;
-            cursor: pointer;
-            font-size: 15px;
-        }
-        .btn:hover {
-            background: var(--primary-dark);
-        }
-        .btn-download {
-            background: var(--success);
-        }
-        .alert {
-            padding: 14px 18px;
-            border-radius: 8px;
-            margin-bottom: 20px;
-            font-weight: 500;
-        }
-        .alert-success {
-            background: #e6f4ea;
-            color: #137333;
-            border: 1px solid #8fd694;
-        }
-        [data-theme="dark"] .alert-success {
-            background: #1e3a2a;
-            border-color: #3a5a40;
-        }
-        .alert-error {
-            background: #fce8e6;
-            color: #c5221f;
-            border: 1px solid #f28b82;
-        }
-        [data-theme="dark"] .alert-error {
-            background: #3a1e1e;
-            border-color: #5a3a3a;
-        }
-        .form-control {
-            width: 100%;
-            padding: 12px;
-            border: 1px solid var(--border);
-            border-radius: 8px;
-            font-size: 15px;
-            background: var(--card-bg);
-            color: var(--text);
-        }
-        footer {
-            text-align: center;
-            margin-top: 40px;
-            color: var(--text-light);
-            font-size: 14px;
-        }
-        @media (max-width: 600px) {
-            .btn {
-                width: 100%;
-                padding: 12px;
-            }
-        }
-    </style>
+    <link rel="stylesheet" href="{{ asset_url('style.css') }}">
 </head>
 <body data-theme="{{ 'dark' if dark_mode else 'light' }}">
     <header>
@@ -309,20 +1250,90 @@ BASE_TEMPLATE = '''
         <p>Школьная библиотека</p>
     </footer>
 
-    <script>
-        // Автоматическое определение темной темы
-        if (localStorage.theme === 'dark' || 
-            (!('theme' in localStorage) && window.matchMedia('(prefers-color-scheme: dark)').matches)) {
-            document.body.setAttribute('data-theme', 'dark');
-        } else {
-            document.body.setAttribute('data-theme', 'light');
-        }
-    </script>
+    <script src="{{ asset_url('theme.js') }}"></script>
 </body>
 </html>
 '''
 
 
+# === Статические ресурсы ===
+# CSS и JS из static/ при старте получают имя с хэшем содержимого и сжимаются заранее;
+# отдаются с immutable-кэшем, так что страница несёт только свою разметку.
+def _compress(data, encoding, best=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else GZIP_LEVEL, mtime=0)
+
+
+def _build_assets():
+    assets = {}
+    urls = {}
+    for name, mimetype in STATIC_ASSETS.items():
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        base, ext = os.path.splitext(name)
+        fingerprinted = f"{base}.{digest}{ext}"
+        bodies = {'identity': data, 'gzip': _compress(data, 'gzip', best=True)}
+        if brotli is not None:
+            bodies['br'] = _compress(data, 'br', best=True)
+        assets[fingerprinted] = {"mimetype": mimetype, "etag": digest, "bodies": bodies}
+        urls[name] = f"/assets/{fingerprinted}"
+    return assets, urls
+
+
+ASSETS, ASSET_URLS = _build_assets()
+
+
+def asset_url(name):
+    return ASSET_URLS[name]
+
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+
+def negotiate_encoding(available):
+    for encoding in ('br', 'gzip'):
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+@app.route('/assets/<name>')
+def asset(name):
+    entry = ASSETS.get(name)
+    if entry is None:
+        abort(404)
+    encoding = negotiate_encoding(entry['bodies'])
+    response = app.response_class(entry['bodies'][encoding or 'identity'], mimetype=entry['mimetype'])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{entry['etag']}-{encoding or 'identity'}")
+    return response.make_conditional(request)
+
+
+@app.after_request
+def compress_response(response):
+    # direct_passthrough — файлы из send_file: их не читаем в память и не пережимаем
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = negotiate_encoding({'br', 'gzip'} if brotli is not None else {'gzip'})
+    if encoding is None:
+        return response
+    response.set_data(_compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
 def render_page(page_title, content_html):
     dark_mode = session.get('dark_mode', False)
     return render_template_string(BASE_TEMPLATE, page_title=page_title, content_html=content_html, dark_mode=dark_mode)
@@ -335,13 +1346,21 @@ def index():
     subject_filter = request.args.get('subject', '').strip()
 
     lessons = load_lessons()
+    content_matches = search_content(query) if query else {}
+    downloads = download_counts()
 
     # Фильтрация
     filtered = []
+    snippets = {}
     for lesson in lessons:
-        title_match = query in lesson['title'].lower() or query in lesson.get('description', '').lower()
         subject_match = (not subject_filter) or lesson.get('subject') == subject_filter
-        if title_match and subject_match:
+        if not subject_match:
+            continue
+        title_match = query in lesson['title'].lower() or query in lesson.get('description', '').lower()
+        if not title_match and lesson['filename'] in content_matches:
+            snippets[lesson['filename']] = content_matches[lesson['filename']]
+            title_match = True
+        if title_match:
             filtered.append(lesson)
 
     # Уникальные предметы
@@ -350,21 +1369,23 @@ def index():
     lessons_html = ""
     if filtered:
         for lesson in filtered:
-            file_type = get_file_type(lesson['filename'])
-            view_url = url_for('view_file', filename=lesson['filename']) if file_type in ['pdf', 'text',
-                                                                                          'image'] else '#'
+            file_type = lesson_file_type(lesson)
+            view_url = url_for('view_file', filename=lesson['filename']) if file_type in VIEWABLE_TYPES else '#'
             download_url = url_for('download_file', filename=lesson['filename'])
+            snippet = snippets.get(lesson['filename'])
+            snippet_html = f'<div style="font-size: 14px; margin-bottom: 12px;">🔎 {escape(snippet)}</div>' if snippet else ''
 
             lessons_html += f'''
             <div class="card">
                 <div style="font-size: 20px; font-weight: 500; margin-bottom: 8px;">{lesson["title"]}</div>
                 <div style="color: var(--text-light); margin-bottom: 16px; font-size: 15px;">
                     {lesson.get("description", "")}
-                    <br><small>📁 {lesson.get("subject", "Без категории")} • 📥 {lesson.get("downloads", 0)} скачиваний</small>
+                    <br><small>📁 {lesson.get("subject", "Без категории")} • 📥 {downloads.get(lesson["filename"], 0)} скачиваний</small>
                 </div>
+                {snippet_html}
                 <div style="display: flex; gap: 10px; flex-wrap: wrap;">
                     <a href="{download_url}" class="btn btn-download">📥 Скачать</a>
-                    {'<a href="' + view_url + '" class="btn" target="_blank">👁️ Просмотреть</a>' if file_type in ['pdf', 'text', 'image'] else ''}
+                    {'<a href="' + view_url + '" class="btn" target="_blank">👁️ Просмотреть</a>' if file_type in VIEWABLE_TYPES else ''}
                 </div>
             </div>
             '''
@@ -377,7 +1398,7 @@ def index():
         <form method="GET" style="display: flex; gap: 10px; flex-wrap: wrap; align-items: end;">
             <div style="flex: 1; min-width: 200px;">
                 <label>Поиск</label>
-                <input type="text" name="q" value="{query}" class="form-control" placeholder="Название или описание...">
+                <input type="text" name="q" value="{query}" class="form-control" placeholder="Название, описание или текст файла...">
             </div>
             <div style="min-width: 150px;">
                 <label>Предмет</label>
@@ -405,12 +1426,16 @@ def index():
 # === Просмотр файлов онлайн ===
 @app.route('/view/<filename>')
 def view_file(filename):
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    if not os.path.exists(filepath):
+    lesson = lesson_by_filename(filename)
+    if lesson is None:
         flash("❌ Файл не найден.", "error")
         return redirect(url_for('index'))
 
-    file_type = get_file_type(filename)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file_type = lesson_file_type(lesson)
+    if file_type not in VIEWABLE_TYPES:
+        return redirect(url_for('download_file', filename=filename))
+    record_event('view', filename)
 
     if file_type == 'pdf':
         content = f'<embed src="/uploads/{filename}" type="application/pdf" width="100%" height="800px">'
@@ -424,13 +1449,34 @@ def view_file(filename):
     elif file_type == 'image':
         content = f'<img src="/uploads/{filename}" style="max-width: 100%; height: auto; border-radius: 8px;">'
     else:
-        return redirect(url_for('download_file', filename=filename))
+        # ?t=секунды: старт с ближайшего предшествующего ключевого кадра — один короткий range-запрос
+        times = keyframe_times(filename)
+        start = request.args.get('t', type=float)
+        fragment = f'#t={keyframe_before(times, start):.3f}' if start else ''
+        video = lesson.get('video')
+        info = ''
+        if video:
+            # Переходы по фильму: равные доли длительности, прижатые к ключевым кадрам
+            marks = sorted({keyframe_before(times, video['duration'] * i / VIDEO_SEEK_MARKS)
+                            for i in range(1, VIDEO_SEEK_MARKS)} - {0}) if times else []
+            seek_html = " ".join(
+                f'<a href="{url_for("view_file", filename=filename, t=f"{mark:.3f}")}">{format_duration(mark)}</a>'
+                for mark in marks)
+            info = f'<p style="color: var(--text-light); margin-top: 8px;">⏱️ {format_duration(video["duration"])} {seek_html}</p>'
+        content = f'''<video controls preload="metadata" playsinline src="/uploads/{filename}{fragment}"
+                            style="width: 100%; border-radius: 8px; background: black;"></video>{info}'''
 
     return render_page(f"👁️ Просмотр: {filename}",
                        f'<div class="card">{content}</div><p><a href="/">← Назад к библиотеке</a></p>')
 
 
-# === Скачивание с счётчиком ===
+# === Файлы для встроенного просмотра (с поддержкой Range) ===
+@app.route('/uploads/<filename>')
+def uploaded_file(filename):
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+
+
+# === Скачивание (счётчик ведёт аналитика) ===
 @app.route('/download/<filename>')
 def download_file(filename):
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
@@ -438,16 +1484,17 @@ def download_file(filename):
         flash("❌ Файл не найден.", "error")
         return redirect(url_for('index'))
 
-    lessons = load_lessons()
-    for lesson in lessons:
-        if lesson['filename'] == filename:
-            lesson['downloads'] = lesson.get('downloads', 0) + 1
-            break
-    save_lessons(lessons)
-
+    record_event('download', filename)
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
 
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    # Превышение MAX_CONTENT_LENGTH отсекается по заголовку ещё до чтения тела запроса
+    flash("❌ Файл слишком большой (максимум 50 МБ).", "error")
+    return redirect(url_for('teacher_upload'))
+
+
 # === Регистрация ===
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -572,7 +1619,27 @@ def admin_panel():
     teacher = load_teacher()
     lessons = load_lessons()
     total_files = len(lessons)
-    total_downloads = sum(lesson.get('downloads', 0) for lesson in lessons)
+    aggregates = load_analytics()
+    total_downloads = aggregates['totals'].get('download', 0)
+    total_views = aggregates['totals'].get('view', 0)
+    titles = {lesson['filename']: lesson['title'] for lesson in lessons}
+
+    def top_html(kind):
+        rows = "".join(f'<li>{titles.get(filename, escape(filename))} — {count}</li>'
+                       for count, filename in top_lessons(aggregates, kind))
+        return f'<ol style="padding-left: 20px;">{rows}</ol>' if rows else '<p>Пока нет данных.</p>'
+
+    def trend_html(trend, label):
+        peak = max([1] + [counts.get(kind, 0) for _, counts in trend for kind in EVENT_KINDS])
+        return "".join(f'''
+        <div style="display: flex; align-items: center; gap: 8px; font-size: 14px;">
+            <span style="width: 50px; color: var(--text-light);">{label(key)}</span>
+            <span style="flex: 1;">
+                <span style="display: block; height: 8px; width: {100 * counts.get('download', 0) // peak}%; background: var(--success);"></span>
+                <span style="display: block; height: 8px; width: {100 * counts.get('view', 0) // peak}%; background: var(--primary);"></span>
+            </span>
+            <span style="width: 70px; text-align: right;">{counts.get('download', 0)} / {counts.get('view', 0)}</span>
+        </div>''' for key, counts in trend)
 
     teacher_html = f'<p><strong>{teacher["username"]}</strong></p>' if teacher else '<p>Нет активного учителя</p>'
 
@@ -596,9 +1663,25 @@ def admin_panel():
     <div class="card">
         <p>📁 Всего материалов: {total_files}</p>
         <p>📥 Всего скачиваний: {total_downloads}</p>
+        <p>👁️ Всего просмотров: {total_views}</p>
+    </div>
+    <h2>🏆 Популярное за 7 дней</h2>
+    <div class="card">
+        <h3>📥 Скачивания</h3>
+        {top_html('download')}
+        <h3 style="margin-top: 16px;">👁️ Просмотры</h3>
+        {top_html('view')}
     </div>
+    <h2>📈 Скачивания / просмотры за 14 дней</h2>
+    <div class="card">{trend_html(daily_trend(aggregates), lambda day: day[5:])}</div>
+    <h2>🕐 Скачивания / просмотры за 24 часа</h2>
+    <div class="card">{trend_html(hourly_trend(aggregates), lambda hour: hour[11:] + ':00')}</div>
     <h2>✅ Активный учитель</h2>
     <div class="card">{teacher_html}</div>
+    <h2>🧹 Файлы</h2>
+    <div class="card">
+        <a href="/admin/fsck" class="btn">🔍 Проверить папку загрузок</a>
+    </div>
     <h2>📥 Заявки</h2>
     {pending_html or '<p>Нет заявок.</p>'}
     '''
@@ -630,6 +1713,65 @@ def delete_teacher():
     return redirect(url_for('admin_panel'))
 
 
+@app.route('/admin/fsck', methods=['GET', 'POST'])
+@admin_required
+def admin_fsck():
+    report = scan_uploads()
+    if request.method == 'POST':
+        removed, freed = reclaim_orphans(report)
+        flash(f"✅ Удалено файлов: {removed}, освобождено {format_size(freed)}.", "success")
+        return redirect(url_for('admin_fsck'))
+
+    orphans_html = "".join(
+        f'<li>{escape(o["path"])} — {format_size(o["size"])}'
+        f'{" (свежий, пропускается)" if o["age"] < ORPHAN_GRACE_SECONDS else ""}</li>'
+        for o in report['orphans'])
+    missing_html = "".join(f'<li>{lesson["title"]} — {escape(lesson["filename"])}</li>' for lesson in report['missing'])
+    damaged_html = "".join(f'<li>{lesson["title"]} — {escape(lesson["filename"])}</li>' for lesson in report['damaged'])
+    orphans_size = sum(o['size'] for o in report['orphans'])
+    reclaim_html = '''
+        <form method="POST" style="margin-top: 12px;" onsubmit="return confirm('Удалить лишние файлы?');">
+            <button type="submit" class="btn" style="background: var(--error);">🧹 Удалить лишние файлы</button>
+        </form>''' if orphans_html else ''
+
+    content = f'''
+    <p><a href="/admin">← Назад в админку</a></p>
+    <div class="card">
+        <p>✅ Проверено файлов: {report["checked"]}</p>
+        <p>🗑️ Лишних файлов: {len(report["orphans"])} ({format_size(orphans_size)})</p>
+        <p>❓ Записей без файла: {len(report["missing"])}</p>
+        <p>⚠️ Повреждённых файлов: {len(report["damaged"])}</p>
+    </div>
+    <h2>🗑️ Лишние файлы</h2>
+    <div class="card">
+        {'<ul>' + orphans_html + '</ul>' if orphans_html else '<p>Нет.</p>'}
+        {reclaim_html}
+    </div>
+    <h2>❓ Записи без файла</h2>
+    <div class="card">{'<ul>' + missing_html + '</ul>' if missing_html else '<p>Нет.</p>'}</div>
+    <h2>⚠️ Размер или хэш не совпадают</h2>
+    <div class="card">{'<ul>' + damaged_html + '</ul>' if damaged_html else '<p>Нет.</p>'}</div>
+    '''
+    return render_page("🧹 Проверка файлов", content)
+
+
+@app.cli.command('fsck')
+@click.option('--reclaim', is_flag=True, help='Удалить лишние файлы из папок загрузок и индексов видео.')
+def fsck_command(reclaim):
+    """Сверить lessons.json с папкой загрузок."""
+    report = scan_uploads()
+    click.echo(f"Проверено файлов: {report['checked']}")
+    for orphan in report['orphans']:
+        click.echo(f"лишний файл: {orphan['path']} ({format_size(orphan['size'])})")
+    for lesson in report['missing']:
+        click.echo(f"нет файла: {lesson['filename']} (урок #{lesson.get('id')})")
+    for lesson in report['damaged']:
+        click.echo(f"повреждён: {lesson['filename']} (урок #{lesson.get('id')})")
+    if reclaim:
+        removed, freed = reclaim_orphans(report)
+        click.echo(f"Удалено файлов: {removed}, освобождено {format_size(freed)}")
+
+
 @app.route('/admin/logout')
 def admin_logout():
     session.pop('admin_logged_in', None)
@@ -651,13 +1793,11 @@ def teacher_upload():
         elif not allowed_file(file.filename):
             flash("❌ Недопустимый формат файла.", "error")
         else:
+            extension = file.filename.rsplit('.', 1)[1].lower()
             filename = secure_filename(file.filename)
-            if not filename:
-                ext = os.path.splitext(file.filename)[1].lower()
-                if ext not in ['.pdf', '.doc', '.docx', '.ppt', '.pptx', '.txt', '.zip', '.jpg', '.jpeg', '.png',
-                               '.mp4']:
-                    ext = '.bin'
-                filename = f"upload_{uuid.uuid4().hex}{ext}"
+            # secure_filename отбрасывает кириллицу и может съесть имя вместе с расширением
+            if not filename.lower().endswith('.' + extension):
+                filename = f"upload_{uuid.uuid4().hex}.{extension}"
 
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             counter = 1
@@ -668,11 +1808,18 @@ def teacher_upload():
                 counter += 1
 
             try:
-                file.save(filepath)
+                meta = file.stream.commit(filepath)
             except Exception as e:
                 flash(f"❌ Ошибка сохранения файла: {str(e)}", "error")
                 return redirect(url_for('teacher_upload'))
 
+            if extension == 'mp4':
+                try:
+                    meta.update(prepare_mp4(filepath, filename))
+                except (ValueError, struct.error, OSError) as e:
+                    # Видео без индекса всё равно можно скачать и посмотреть — браузер найдёт moov сам
+                    app.logger.warning(f"Не удалось проиндексировать видео {filename}: {e}")
+
             lessons = load_lessons()
             lessons.append({
                 "id": len(lessons) + 1,
@@ -680,14 +1827,19 @@ def teacher_upload():
                 "description": description,
                 "subject": subject,
                 "filename": filename,
-                "downloads": 0
+                **meta
             })
             try:
                 save_lessons(lessons)
             except Exception as e:
+                try:
+                    os.remove(filepath)
+                except Exception as remove_error:
+                    app.logger.error(f"Ошибка удаления файла: {remove_error}")
                 flash(f"❌ Ошибка сохранения данных: {str(e)}", "error")
                 return redirect(url_for('teacher_upload'))
 
+            enqueue_extraction(filename)
             flash("✅ Материал успешно добавлен!", "success")
             return redirect(url_for('teacher_upload'))
 
@@ -695,16 +1847,15 @@ def teacher_upload():
     lessons_html = ""
     if lessons:
         for lesson in lessons:
-            file_type = get_file_type(lesson['filename'])
-            view_url = url_for('view_file', filename=lesson['filename']) if file_type in ['pdf', 'text',
-                                                                                          'image'] else '#'
+            file_type = lesson_file_type(lesson)
+            view_url = url_for('view_file', filename=lesson['filename']) if file_type in VIEWABLE_TYPES else '#'
             lessons_html += f'''
             <div class="card">
                 <div style="font-size: 20px; font-weight: 500;">{lesson["title"]}</div>
                 <div style="color: var(--text-light); margin: 8px 0;">{lesson.get("subject", "Без категории")}</div>
                 <div style="display: flex; gap: 10px; flex-wrap: wrap; margin-top: 12px;">
                     <a href="{url_for('download_file', filename=lesson['filename'])}" class="btn btn-download">📥 Скачать</a>
-                    {'<a href="' + view_url + '" class="btn" target="_blank">👁️ Просмотреть</a>' if file_type in ['pdf', 'text', 'image'] else ''}
+                    {'<a href="' + view_url + '" class="btn" target="_blank">👁️ Просмотреть</a>' if file_type in VIEWABLE_TYPES else ''}
                     <form method="POST" action="{url_for('delete_lesson', lesson_id=lesson['id'])}" 
                           onsubmit="return confirm('Удалить?');">
                         <button type="submit" class="btn" style="background: var(--error);">🗑️ Удалить</button>
@@ -766,38 +1917,71 @@ def delete_lesson(lesson_id):
         flash("❌ Материал не найден.", "error")
         return redirect(url_for('teacher_upload'))
 
+    # Сначала каталог, потом файл: при сбое остаётся лишний файл (его уберёт fsck), а не запись без файла
+    lessons = [lesson for lesson in lessons if lesson.get('id') != lesson_id]
+    try:
+        save_lessons(lessons)
+    except Exception as e:
+        flash(f"❌ Ошибка: {str(e)}", "error")
+        return redirect(url_for('teacher_upload'))
+
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], lesson_to_delete['filename'])
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
     except Exception as e:
         app.logger.error(f"Ошибка удаления файла: {e}")
-
-    lessons = [lesson for lesson in lessons if lesson.get('id') != lesson_id]
+    remove_from_content_index(lesson_to_delete['filename'])
     try:
-        save_lessons(lessons)
-        flash("✅ Материал удалён!", "success")
+        os.remove(video_index_path(lesson_to_delete['filename']))
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        flash(f"❌ Ошибка: {str(e)}", "error")
+        app.logger.error(f"Ошибка удаления индекса видео: {e}")
+    flash("✅ Материал удалён!", "success")
 
     return redirect(url_for('teacher_upload'))
 
 
 # === Экспорт в ZIP ===
+def _export_fingerprint(files):
+    # Отпечаток набора файлов каталога (имя, размер, mtime); счётчик скачиваний в lessons.json на него не влияет
+    digest = hashlib.sha256()
+    for filename, stat in files:
+        digest.update(f"{filename}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest().encode('ascii')
+
+
+def _export_cached_fingerprint():
+    try:
+        with zipfile.ZipFile(EXPORT_FILE) as zipf:
+            return zipf.comment
+    except (OSError, zipfile.BadZipFile):
+        return None
+
+
 @app.route('/export')
 @teacher_required
 def export_all():
-    zip_path = os.path.join(UPLOAD_FOLDER, 'library_export.zip')
+    # Архив собирается вне папки загрузок, содержит только файлы из каталога
+    # и пересобирается, только если набор файлов изменился; отпечаток хранится в комментарии ZIP
     try:
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, dirs, files in os.walk(UPLOAD_FOLDER):
-                for file in files:
-                    if file == 'library_export.zip':
-                        continue
-                    full_path = os.path.join(root, file)
-                    arcname = os.path.relpath(full_path, UPLOAD_FOLDER)
-                    zipf.write(full_path, arcname)
-        return send_file(zip_path, as_attachment=True)
+        files = []
+        for filename in sorted({lesson['filename'] for lesson in load_lessons()}):
+            try:
+                files.append((filename, os.stat(os.path.join(UPLOAD_FOLDER, filename))))
+            except FileNotFoundError:
+                continue
+        fingerprint = _export_fingerprint(files)
+        if _export_cached_fingerprint() != fingerprint:
+            tmp_path = tmp_path_for(EXPORT_FILE)
+            with zipfile.ZipFile(tmp_path, 'w') as zipf:
+                for filename, _ in files:
+                    zipf.write(os.path.join(UPLOAD_FOLDER, filename), filename)
+                zipf.comment = fingerprint
+            os.replace(tmp_path, EXPORT_FILE)
+        return send_file(os.path.abspath(EXPORT_FILE), as_attachment=True)
     except Exception as e:
         flash(f"Ошибка экспорта: {e}", "error")
         return redirect(url_for('teacher_upload'))
@@ -812,7 +1996,215 @@ def logout():
     return redirect(url_for('index'))
 
 
+# === ASGI-режим ===
+# Обработчики Flask выполняются в пуле потоков, а тела файлов (ответы с X-Sendfile
+# от send_file/send_from_directory) отдаёт событийный цикл уже после того, как поток
+# освободился. Так 30 учеников, качающих одно видео, не занимают все потоки.
+class _FileWrapper:
+    def __init__(self, file, block_size=STREAM_CHUNK_SIZE):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.file.read(self.block_size), b'')
+
+    def close(self):
+        self.file.close()
+
+
+class AsgiAdapter:
+    def __init__(self, wsgi_app, threads=WEB_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-worker')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Включается только под ASGI-сервером: WSGI-серверы X-Sendfile не обрабатывают
+                self.wsgi_app.config['USE_X_SENDFILE'] = True
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _environ(self, scope, body):
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+            'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': _FileWrapper,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            value = value.decode('latin-1')
+            environ[name] = f"{environ[name]},{value}" if name in environ else value
+        return environ
+
+    def _run_wsgi(self, environ):
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        result = self.wsgi_app(environ, start_response)
+        if isinstance(result, _FileWrapper):
+            return started['status'], started['headers'], result
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started['status'], started['headers'], body
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body.seek(0)
+        try:
+            status, headers, result = await loop.run_in_executor(
+                self.executor, self._run_wsgi, self._environ(scope, body))
+        finally:
+            body.close()
+
+        sendfile_path = None
+        raw_headers = []
+        for name, value in headers:
+            if name.lower() == 'x-sendfile':
+                sendfile_path = value
+            elif name.lower() != 'date':  # Date ставит сам ASGI-сервер
+                raw_headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+
+        if scope['method'] == 'HEAD' or status < 200 or status in (204, 304):
+            if isinstance(result, _FileWrapper):
+                result.close()
+            await send({'type': 'http.response.body', 'body': b''})
+        elif sendfile_path is not None:
+            start, length = self._byte_range(headers)
+            with open(sendfile_path, 'rb') as f:
+                await self._send_file(scope, receive, send, f, start, length)
+        elif isinstance(result, _FileWrapper):
+            with result.file:
+                await self._send_file(scope, receive, send, result.file, None, None)
+        else:
+            await send({'type': 'http.response.body', 'body': result})
+
+    @staticmethod
+    def _byte_range(headers):
+        headers = {name.lower(): value for name, value in headers}
+        content_range = headers.get('content-range')
+        if content_range:
+            # "bytes 100-199/1000"
+            first, last = content_range.split(' ', 1)[1].split('/', 1)[0].split('-')
+            return int(first), int(last) - int(first) + 1
+        return 0, int(headers['content-length'])
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def _send_file(self, scope, receive, send, f, start, length):
+        loop = asyncio.get_running_loop()
+        if start is not None and 'http.response.zerocopysend' in scope.get('extensions', {}):
+            await send({'type': 'http.response.zerocopysend', 'file': f, 'offset': start, 'count': length})
+            return
+        if start is not None:
+            f.seek(start)
+        # После ухода клиента send() у uvicorn молча ничего не делает — без этой
+        # проверки файл дочитывался бы с диска до конца впустую
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = STREAM_CHUNK_SIZE if remaining is None else min(STREAM_CHUNK_SIZE, remaining)
+                chunk = await loop.run_in_executor(None, f.read, size)
+                if not chunk or disconnected.done():
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+
+
+asgi_app = AsgiAdapter(app)
+
+
 # === Запуск ===
-if __name__ == '__main__':
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def serve():
+    host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    server = SERVER
+    if server == 'auto':
+        # gunicorn не импортируется на Windows — там берём waitress
+        server = next((name for name in ('gunicorn', 'waitress') if _importable(name)), 'dev')
+
+    if server == 'gunicorn':
+        from gunicorn.app.base import BaseApplication
+
+        class GunicornApp(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f"{host}:{port}")
+                self.cfg.set('workers', WEB_CONCURRENCY)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('threads', WEB_THREADS)
+                self.cfg.set('sendfile', True)  # send_file отдаёт тело через os.sendfile
+
+            def load(self):
+                return app
+
+        GunicornApp().run()
+    elif server == 'waitress':
+        import waitress
+        waitress.serve(app, host=host, port=port, threads=WEB_THREADS)
+    elif server == 'uvicorn':
+        import uvicorn
+        uvicorn.run('app:asgi_app', host=host, port=port, workers=WEB_CONCURRENCY)
+    else:
+        app.run(host=host, port=port, threaded=True)
+
+
+if __name__ == '__main__':
+    serve()
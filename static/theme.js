@@ -0,0 +1,7 @@
+// Автоматическое определение темной темы
+if (localStorage.theme === 'dark' || 
+    (!('theme' in localStorage) && window.matchMedia('(prefers-color-scheme: dark)').matches)) {
+    document.body.setAttribute('data-theme', 'dark');
+} else {
+    document.body.setAttribute('data-theme', 'light');
+}